@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+"""local runner daemon of the testsuite
+
+The daemon owns the cores and memory of the node and keeps a persistent queue
+of test cases. Submissions are accepted as line-delimited JSON over a Unix socket.
+Each case is run by the driver gap_test.py in a subprocess, since TestCase
+switches the working directory of the process.
+
+Requires Python >= 3.7
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import subprocess as sp
+from shutil import rmtree
+
+from .utils import create_logger
+from .testcase import rootdir, refersdir, find_tests, preflight, TestCase
+from .store import ResultStore
+
+default_socket = os.path.join(rootdir, "gapd.sock")
+default_state = os.path.join(rootdir, "gapd_state.json")
+driver = os.path.join(rootdir, "gap_test.py")
+
+_logger = create_logger("gapd", log=False, stream=True)
+
+
+class Job(object):
+    """a test case in the daemon queue
+
+    Args:
+        jid (int): job id
+        sid (int): id of the submission containing the job
+        submitter (str): name of submitter, used for fair share
+        tcname (str): name of testcase
+        gap_version (str)
+        gap_suffix (str)
+        maxprocs (int): maximal number of processors, None for no limit
+        mem (float): memory in GB required by the case
+        workspace (str): working directory relative to rootdir
+        dry (bool): fake run for workflow test
+
+    The run ID is chosen when the job starts and passed to the driver,
+    such that the results of the job are found in the result store.
+    """
+    keys = ["jid", "sid", "submitter", "tcname", "gap_version", "gap_suffix",
+            "maxprocs", "mem", "workspace", "dry",
+            "state", "nprocs", "returncode", "submit_time", "start_time", "end_time",
+            "run_id", "gap_ks", "gap_qp", "walltime"]
+
+    def __init__(self, jid, sid, submitter, tcname, gap_version, gap_suffix=None,
+                 maxprocs=None, mem=0.0, workspace=None, dry=False, **kwargs):
+        self.jid = jid
+        self.sid = sid
+        self.submitter = submitter
+        self.tcname = tcname
+        self.gap_version = gap_version
+        self.gap_suffix = gap_suffix
+        self.maxprocs = maxprocs
+        self.mem = mem
+        self.workspace = workspace
+        self.dry = dry
+        self.state = kwargs.get("state", "queued")
+        self.nprocs = kwargs.get("nprocs", None)
+        self.returncode = kwargs.get("returncode", None)
+        self.submit_time = kwargs.get("submit_time", time.time())
+        self.start_time = kwargs.get("start_time", None)
+        self.end_time = kwargs.get("end_time", None)
+        self.run_id = kwargs.get("run_id", None)
+        self.gap_ks = kwargs.get("gap_ks", None)
+        self.gap_qp = kwargs.get("gap_qp", None)
+        self.walltime = kwargs.get("walltime", None)
+
+    def to_dict(self):
+        """dict of job attributes, for saving and reporting"""
+        return {k: getattr(self, k) for k in self.keys}
+
+    def command(self):
+        """command line to run the job by the driver"""
+        cmds = [sys.executable, driver, self.gap_version, "-i", self.tcname,
+                "-n", str(self.nprocs), "-d", self.workspace,
+                "-l", os.path.join(self.workspace, "gaptest"), "-a",
+                "--id", self.run_id]
+        if self.gap_suffix is not None:
+            cmds.extend(["--gf", self.gap_suffix])
+        if self.dry:
+            cmds.append("--dry")
+        return cmds
+
+    @property
+    def casedir(self):
+        """str, absolute path of the workspace of the case"""
+        return os.path.join(rootdir, self.workspace, self.tcname)
+
+    def collect_results(self, path_store=refersdir):
+        """gaps and walltime of the job from the result store, if stored by the job"""
+        runs = ResultStore(path_store).select(case=self.tcname, version=self.gap_version,
+                                              suffix=self.gap_suffix or "", run_id=self.run_id)
+        if len(runs) == 0:
+            _logger.warning("no results of job %d stored as run %s", self.jid, self.run_id)
+            return
+        for key in ["gap_ks", "gap_qp", "walltime"]:
+            value = float(runs[key][-1])
+            setattr(self, key, None if value != value else value)
+
+    @property
+    def elapsed(self):
+        """float, running time in seconds"""
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+
+
+class Scheduler(object):
+    """fair-share scheduler of submitted test cases
+
+    Queued jobs of different submitters are started in round-robin.
+    A job is started with the largest useful number of processors that fits
+    the free cores and the fair share of its submitter.
+
+    Args:
+        cores (int): number of cores owned by the daemon
+        mem (float): memory in GB owned by the daemon, None for no limit
+        path_state (str): file to save the queue
+    """
+    def __init__(self, cores, mem=None, path_state=default_state):
+        self.cores = cores
+        self.mem = mem
+        self._path_state = path_state
+        self.jobs = []
+        self._nsubmit = 0
+        self._rr = []
+        self._cases = {}
+        self._tasks = set()
+        self._shutdown = None
+        self._load_state()
+
+    @property
+    def free_cores(self):
+        """int, number of cores not occupied by running jobs"""
+        return self.cores - sum(j.nprocs for j in self.jobs if j.state == "running")
+
+    @property
+    def free_mem(self):
+        """float, memory not occupied by running jobs"""
+        if self.mem is None:
+            return float("inf")
+        return self.mem - sum(j.mem for j in self.jobs if j.state == "running")
+
+    def _load_state(self):
+        """load the persistent queue.
+
+        Interrupted jobs are queued again, with their case workspace removed
+        such that the driver does not skip them.
+        """
+        if self._path_state is None or not os.path.isfile(self._path_state):
+            return
+        with open(self._path_state, 'r') as h:
+            d = json.load(h)
+        self._nsubmit = d["nsubmit"]
+        for x in d["jobs"]:
+            job = Job(**x)
+            if job.state == "running":
+                job.state = "queued"
+                job.nprocs = None
+                job.start_time = None
+                job.run_id = None
+                if os.path.isdir(job.casedir):
+                    rmtree(job.casedir)
+            self.jobs.append(job)
+        _logger.info("loaded %d jobs from %s", len(self.jobs), self._path_state)
+
+    def _save_state(self):
+        """save the persistent queue, replacing the old file only when complete"""
+        if self._path_state is None:
+            return
+        path_tmp = self._path_state + ".tmp"
+        with open(path_tmp, 'w') as h:
+            json.dump({"nsubmit": self._nsubmit,
+                       "jobs": [j.to_dict() for j in self.jobs]}, h, indent=1)
+        os.replace(path_tmp, self._path_state)
+
+    def _get_nprocs_candidates(self, tcname, maxprocs=None):
+        """useful numbers of processors of a case not exceeding maxprocs
+
+        The same numbers as used by the driver and preflight, i.e. TestCase.gap_nprocs,
+        cached for all submissions. Serial run if none of them fits.
+        """
+        if tcname not in self._cases:
+            self._cases[tcname] = TestCase(tcname, _logger).gap_nprocs
+        maxprocs = min(maxprocs or self.cores, self.cores)
+        return [x for x in self._cases[tcname] if x <= maxprocs] or [1,]
+
+    def submit(self, gap_version, gap_suffix=None, include=None, exclude=None,
+               submitter="anonymous", nprocs=None, mem=0.0, dry=False):
+        """add test cases to the queue
+
+        Returns:
+            dict, with submission id and names of queued cases
+        """
+        if self.mem is not None and mem > self.mem:
+            raise ValueError("memory %.1f GB per case exceeds %.1f GB owned by the daemon"
+                             % (mem, self.mem))
+        tcnames = find_tests(include=include, exclude=exclude)
+        tcs = [TestCase(x, _logger) for x in tcnames]
+        for tc in tcs:
+            self._cases[tc.tcname] = tc.gap_nprocs
+        # refuse the submission before queueing if anything is missing on this node
+        preflight(tcs, gap_version, gap_suffix, nprocs=min(nprocs or self.cores, self.cores),
+                  any_nprocs=True, dry=dry)
+        self._nsubmit += 1
+        sid = self._nsubmit
+        jid = max([j.jid for j in self.jobs] + [0,])
+        workspace = os.path.join("workspace", "gapd-{}".format(sid))
+        for i, tcname in enumerate(tcnames):
+            self.jobs.append(Job(jid+i+1, sid, submitter, tcname, gap_version,
+                                 gap_suffix=gap_suffix, maxprocs=nprocs, mem=mem,
+                                 workspace=workspace, dry=dry))
+        _logger.info("submission %d from %s: %d cases", sid, submitter, len(tcnames))
+        self._save_state()
+        self.schedule()
+        return {"sid": sid, "cases": tcnames, "workspace": workspace}
+
+    def status(self, sid=None):
+        """summary of jobs, optionally of submission sid only"""
+        jobs = [j for j in self.jobs if sid is None or j.sid == sid]
+        summary = {}
+        for j in jobs:
+            summary[j.state] = summary.get(j.state, 0) + 1
+        return {"cores": self.cores, "free_cores": self.free_cores,
+                "summary": summary,
+                "jobs": [dict(j.to_dict(), elapsed=j.elapsed) for j in jobs]}
+
+    def cancel(self, sid):
+        """remove queued jobs of submission sid. Running jobs are not affected"""
+        n = 0
+        for j in self.jobs:
+            if j.sid == sid and j.state == "queued":
+                j.state = "cancelled"
+                n += 1
+        self._save_state()
+        return {"sid": sid, "cancelled": n}
+
+    def pick(self):
+        """pick the next job to start and its number of processors in round-robin
+
+        Returns:
+            (Job, int) or (None, None) if no queued job fits the free resources
+        """
+        queued = [j for j in self.jobs if j.state == "queued"]
+        submitters = []
+        for j in queued:
+            if j.submitter not in submitters:
+                submitters.append(j.submitter)
+        if not submitters:
+            return None, None
+        for s in submitters:
+            if s not in self._rr:
+                self._rr.append(s)
+        active = set(submitters) | set(j.submitter for j in self.jobs if j.state == "running")
+        share = max(1, self.cores // len(active))
+        for s in list(self._rr):
+            if s not in submitters:
+                continue
+            used = sum(j.nprocs for j in self.jobs
+                       if j.state == "running" and j.submitter == s)
+            job = [j for j in queued if j.submitter == s][0]
+            cap = min(self.free_cores, share - used)
+            if job.mem > self.free_mem:
+                continue
+            for n in self._get_nprocs_candidates(job.tcname, job.maxprocs):
+                if n <= cap:
+                    self._rr.remove(s)
+                    self._rr.append(s)
+                    return job, n
+        return None, None
+
+    def schedule(self):
+        """start queued jobs as long as the free resources allow. No job is started
+        after shutdown is requested"""
+        while self._shutdown is None or not self._shutdown.is_set():
+            job, nprocs = self.pick()
+            if job is None:
+                break
+            job.state = "running"
+            job.nprocs = nprocs
+            job.start_time = time.time()
+            job.run_id = "gapd{}-{}".format(job.jid, time.strftime("%y%m%d-%H%M%S"))
+            task = asyncio.ensure_future(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._save_state()
+
+    async def _run(self, job):
+        """run a job by the driver in a subprocess"""
+        wsdir = os.path.join(rootdir, job.workspace)
+        if not os.path.isdir(wsdir):
+            os.makedirs(wsdir)
+        out = os.path.join(wsdir, job.tcname.replace('/', '_') + ".out")
+        _logger.info("start job %d: %s with %d processors", job.jid, job.tcname, job.nprocs)
+        try:
+            with open(out, 'w') as h:
+                proc = await asyncio.create_subprocess_exec(*job.command(), cwd=rootdir,
+                                                            stdout=h, stderr=sp.STDOUT)
+                job.returncode = await proc.wait()
+            job.state = {0: "done"}.get(job.returncode, "failed")
+        except OSError as err:
+            _logger.error("fail to start job %d: %s", job.jid, err)
+            job.state = "failed"
+        job.end_time = time.time()
+        if job.state == "done" and not job.dry:
+            try:
+                job.collect_results()
+            except Exception as err: # pylint: disable=W0703
+                _logger.error("fail to collect results of job %d: %s", job.jid, err)
+        _logger.info("job %d %s in %.1f s", job.jid, job.state, job.elapsed)
+        self.schedule()
+
+    async def wait(self):
+        """wait for all running jobs"""
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def handle(self, reader, writer):
+        """handle one request from the client"""
+        try:
+            request = json.loads((await reader.readline()).decode())
+            cmd = request.pop("cmd")
+            if cmd == "submit":
+                response = self.submit(**request)
+            elif cmd == "status":
+                response = self.status(**request)
+            elif cmd == "cancel":
+                response = self.cancel(**request)
+            elif cmd == "shutdown":
+                response = {"shutdown": True}
+                self._shutdown.set()
+            else:
+                raise ValueError("unknown command %s" % cmd)
+        except Exception as err: # pylint: disable=W0703
+            response = {"error": "%s: %s" % (type(err).__name__, err)}
+        writer.write((json.dumps(response) + "\n").encode())
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, path_socket=default_socket):
+        """serve requests on the Unix socket until shutdown"""
+        self._shutdown = asyncio.Event() # pylint: disable=W0201
+        claim_socket(path_socket)
+        server = await asyncio.start_unix_server(self.handle, path=path_socket)
+        _logger.info("listening on %s with %d cores", path_socket, self.cores)
+        self.schedule()
+        await self._shutdown.wait()
+        server.close()
+        await server.wait_closed()
+        os.unlink(path_socket)
+        _logger.info("shutting down, waiting for %d running jobs", len(self._tasks))
+        await self.wait()
+
+
+def claim_socket(path_socket):
+    """remove a stale socket
+
+    Raises:
+        ValueError if another daemon is listening on path_socket
+    """
+    if not os.path.exists(path_socket):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path_socket)
+        except (ConnectionRefusedError, FileNotFoundError):
+            _logger.info("removing stale socket %s", path_socket)
+            os.unlink(path_socket)
+            return
+    raise ValueError("another daemon is running on %s" % path_socket)
+
+
+def serve(cores=None, mem=None, path_socket=default_socket, path_state=default_state):
+    """start the daemon"""
+    if cores is None:
+        cores = os.cpu_count()
+    # check before loading the queue, which resets the workspaces of running jobs
+    claim_socket(path_socket)
+    asyncio.run(Scheduler(cores, mem=mem, path_state=path_state).serve(path_socket))
+
+
+def request(path_socket=default_socket, **kwargs):
+    """send a request to the daemon and return the response
+
+    Args:
+        path_socket (str): Unix socket of the daemon
+        kwargs: the request, with "cmd" as command
+
+    Raises:
+        ValueError if no daemon is listening on path_socket
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path_socket)
+        except (ConnectionRefusedError, FileNotFoundError):
+            raise ValueError("daemon not running on %s" % path_socket)
+        s.sendall((json.dumps(kwargs) + "\n").encode())
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data.decode())
+
+
+# run itself as test, by python -m backend.daemon
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    import unittest as ut
+    import numpy as np
+    from .store import energy_dtype
+
+    class test_scheduler(ut.TestCase):
+        def setUp(self):
+            self.path = tempfile.mkdtemp()
+            self.path_state = os.path.join(self.path, "gapd_state.json")
+
+        def tearDown(self):
+            shutil.rmtree(self.path)
+
+        def _scheduler(self, cores, mem=None, jobs=()):
+            sched = Scheduler(cores, mem=mem, path_state=self.path_state)
+            sched._cases["x/1_a"] = [8, 4, 2, 1]
+            for i, (submitter, job_mem) in enumerate(jobs):
+                sched.jobs.append(Job(i+1, 1, submitter, "x/1_a", "2e", mem=job_mem,
+                                      workspace=self.path))
+            return sched
+
+        @staticmethod
+        def _start(job, nprocs):
+            job.state = "running"
+            job.nprocs = nprocs
+            job.start_time = time.time()
+
+        def test_pick_alone(self):
+            """a single submitter may take all cores"""
+            sched = self._scheduler(8, jobs=[("a", 0.0), ("a", 0.0)])
+            job, nprocs = sched.pick()
+            self.assertEqual((1, 8), (job.jid, nprocs))
+            self._start(job, nprocs)
+            self.assertEqual((None, None), sched.pick())
+
+        def test_pick_fair_share(self):
+            """two submitters share the cores in round-robin"""
+            sched = self._scheduler(8, jobs=[("a", 0.0), ("a", 0.0), ("b", 0.0), ("b", 0.0)])
+            picked = []
+            while True:
+                job, nprocs = sched.pick()
+                if job is None:
+                    break
+                self._start(job, nprocs)
+                picked.append((job.submitter, nprocs))
+            self.assertListEqual([("a", 4), ("b", 4)], picked)
+            # the share is capped even if the other submitter is idle for now
+            sched = self._scheduler(8, jobs=[("a", 0.0), ("a", 0.0), ("b", 0.0)])
+            self._start(sched.jobs[2], 4)
+            job, nprocs = sched.pick()
+            self.assertEqual(("a", 4), (job.submitter, nprocs))
+            self._start(job, nprocs)
+            self.assertEqual((None, None), sched.pick())
+
+        def test_pick_round_robin(self):
+            """submitters take turns when cores are freed"""
+            sched = self._scheduler(2, jobs=[("a", 0.0), ("a", 0.0), ("b", 0.0), ("b", 0.0)])
+            order = []
+            for _ in range(4):
+                job, nprocs = sched.pick()
+                self._start(job, nprocs)
+                job.state = "done"
+                order.append(job.submitter)
+            self.assertListEqual(["a", "b", "a", "b"], order)
+
+        def test_pick_mem(self):
+            """jobs exceeding the free memory are not started"""
+            sched = self._scheduler(8, mem=10.0, jobs=[("a", 6.0), ("b", 6.0)])
+            job, nprocs = sched.pick()
+            self._start(job, nprocs)
+            self.assertEqual((None, None), sched.pick())
+            job.state = "done"
+            job, _ = sched.pick()
+            self.assertEqual("b", job.submitter)
+
+        def test_reload_state(self):
+            """running jobs are queued again with their workspace removed"""
+            sched = self._scheduler(8, jobs=[("a", 0.0), ("b", 0.0), ("b", 0.0)])
+            self._start(sched.jobs[0], 8)
+            sched.jobs[1].state = "done"
+            os.makedirs(sched.jobs[0].casedir)
+            sched._save_state()
+            sched = Scheduler(8, path_state=self.path_state)
+            self.assertListEqual(["queued", "done", "queued"], [j.state for j in sched.jobs])
+            self.assertIsNone(sched.jobs[0].nprocs)
+            self.assertFalse(os.path.isdir(sched.jobs[0].casedir))
+
+        def test_nprocs_candidates(self):
+            """candidates are limited by maxprocs and cores, serial if none fits"""
+            sched = self._scheduler(8)
+            sched._cases["x/2_b"] = [64, 32, 16]
+            self.assertListEqual([8, 4, 2, 1], sched._get_nprocs_candidates("x/1_a"))
+            self.assertListEqual([4, 2, 1], sched._get_nprocs_candidates("x/1_a", 6))
+            self.assertListEqual([1], sched._get_nprocs_candidates("x/2_b"))
+
+        def test_submit_mem(self):
+            """cases requiring more memory than owned are refused"""
+            sched = self._scheduler(8, mem=10.0)
+            self.assertRaises(ValueError, sched.submit, "2e", mem=20.0)
+            self.assertListEqual([], sched.jobs)
+
+        def test_shutdown(self):
+            """no job is started after shutdown, and failing collection does not stall"""
+            sched = self._scheduler(1, jobs=[("a", 0.0), ("a", 0.0)])
+            def _raise(*args, **kwargs):
+                raise ValueError("broken store")
+            for job in sched.jobs:
+                job.command = lambda: ["sleep", "0.2"]
+                job.collect_results = _raise
+            async def _serve():
+                sched._shutdown = asyncio.Event()
+                sched.schedule()
+                sched._shutdown.set()
+                await sched.wait()
+            asyncio.run(_serve())
+            self.assertListEqual(["done", "queued"], [j.state for j in sched.jobs])
+            sched = Scheduler(1, path_state=self.path_state)
+            self.assertListEqual(["done", "queued"], [j.state for j in sched.jobs])
+
+        def test_collect_results(self):
+            """results are collected by the run ID of the job"""
+            store = ResultStore(self.path)
+            for run_id, eqp in [("gapd1-0", 2.0), ("gapd2-0", 3.0)]:
+                e = np.array([(1, 1, -1.0, -1.0), (1, 2, 1.0, eqp)], dtype=energy_dtype)
+                store.append("x/1_a", "2e", None, run_id, e, walltime=1.0)
+            job = Job(1, 1, "a", "x/1_a", "2e", run_id="gapd1-0")
+            job.collect_results(self.path)
+            self.assertAlmostEqual(3.0, job.gap_qp)
+            job = Job(3, 1, "a", "x/1_a", "2e", run_id="gapd3-0")
+            job.collect_results(self.path)
+            self.assertIsNone(job.gap_qp)
+
+        def test_claim_socket(self):
+            """stale socket is removed, a live one is refused"""
+            path_socket = os.path.join(self.path, "gapd.sock")
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.bind(path_socket)
+            s.listen(1)
+            self.assertRaises(ValueError, claim_socket, path_socket)
+            s.close()
+            claim_socket(path_socket)
+            self.assertFalse(os.path.exists(path_socket))
+    ut.main()
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""append-only columnar store of parsed GAP results
+
+Two tables are kept in the store directory, each with one binary file per column
+
+- runs/<column>.bin: one entry per run, keyed by case, version, suffix and run ID,
+  with gaps, timing and the location of its energies
+- energies/<column>.bin: KS and QP energies of all runs by k-point and band
+
+A quantity of all runs, e.g. the QP gap or the energy of one band, is read from
+one contiguous column.
+Appends from concurrent processes are serialized by an exclusive lock on
+store.lock. While holding it, entries left incomplete by an interrupted append
+are cut off, and the energies are written before the run, hence a run never
+points to incomplete or misaligned data.
+Columns are memory-mapped for reading.
+"""
+# pylint: disable=R0205
+from __future__ import print_function
+import os
+import fcntl
+import numpy as np
+
+from .utils import create_logger
+
+_logger = create_logger("store", log=False, stream=True)
+
+run_dtype = np.dtype([("case", "S64"), ("version", "S16"), ("suffix", "S16"),
+                      ("run_id", "S32"), ("time", "f8"), ("walltime", "f8"),
+                      ("nprocs", "i4"), ("gap_ks", "f8"), ("gap_qp", "f8"),
+                      ("offset", "i8"), ("nrows", "i8")])
+energy_dtype = np.dtype([("ik", "i4"), ("ib", "i4"), ("eks", "f8"), ("eqp", "f8")])
+
+
+def read_eqp(path_eqp):
+    """read KS and QP energies from GAP output, e.g. case.eqpeV_GW
+
+    Data lines start with the indices of k-point and band, followed by energies
+    with the KS energy as the first and the QP energy as the last column.
+    Lines starting with # are skipped.
+
+    Returns:
+        structured array of energy_dtype
+    """
+    rows = []
+    with open(path_eqp, 'r') as h:
+        for l in h:
+            words = l.split()
+            if not words or words[0].startswith('#'):
+                continue
+            try:
+                rows.append((int(words[0]), int(words[1]), float(words[2]), float(words[-1])))
+            except (ValueError, IndexError):
+                continue
+    return np.array(rows, dtype=energy_dtype)
+
+
+def band_gap(energies, efermi=0.0, reference=None):
+    """band gap from energies referenced to the valence band maximum
+
+    Args:
+        energies (array)
+        efermi (float): energy separating occupied and unoccupied states
+        reference (array): energies deciding the occupation, e.g. KS energies
+            for the QP gap. Default to energies
+
+    Returns:
+        float, nan if no state lies on either side
+    """
+    energies = np.asarray(energies)
+    if reference is None:
+        reference = energies
+    occ = np.asarray(reference) <= efermi
+    if occ.all() or not occ.any():
+        return np.nan
+    return energies[~occ].min() - energies[occ].max()
+
+
+def _path_column(path_table, key):
+    return os.path.join(path_table, key + ".bin")
+
+
+def _table_size(path_table, dtype):
+    """number of entries complete in all columns of a table"""
+    sizes = []
+    for key in dtype.names:
+        path = _path_column(path_table, key)
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        sizes.append(size // dtype[key].itemsize)
+    return min(sizes)
+
+
+def _align_table(path_table, dtype):
+    """number of complete entries in a table. Columns are cut off to that number.
+
+    Must be called with the store lock held.
+    """
+    n = _table_size(path_table, dtype)
+    for key in dtype.names:
+        path = _path_column(path_table, key)
+        if os.path.isfile(path) and os.path.getsize(path) != n * dtype[key].itemsize:
+            _logger.warning("cutting off incomplete entries at the end of %s", path)
+            with open(path, 'r+b') as h:
+                h.truncate(n * dtype[key].itemsize)
+    return n
+
+
+def _write_table(path_table, records):
+    for key in records.dtype.names:
+        with open(_path_column(path_table, key), 'ab') as h:
+            h.write(np.ascontiguousarray(records[key]).tobytes())
+
+
+class ResultStore(object):
+    """columnar store of per-case results
+
+    Args:
+        path_store (str): directory of the store, created if not existing
+    """
+    def __init__(self, path_store):
+        self._path_runs = os.path.join(path_store, "runs")
+        self._path_energies = os.path.join(path_store, "energies")
+        self._path_lock = os.path.join(path_store, "store.lock")
+        for d in [self._path_runs, self._path_energies]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        self._maps = {}
+        self._tables = {"runs": (self._path_runs, run_dtype),
+                        "energies": (self._path_energies, energy_dtype)}
+
+    def _map(self, path, dtype, n):
+        """memory-map the first n entries of path, remapped only when n has changed"""
+        cached = self._maps.get(path)
+        if cached is None or len(cached) != n:
+            if n == 0:
+                cached = np.zeros(0, dtype=dtype)
+            else:
+                cached = np.memmap(path, dtype=dtype, mode='r', shape=(n,))
+            self._maps[path] = cached
+        return cached
+
+    def get_columns(self, table="runs"):
+        """memory-mapped columns of a table
+
+        Args:
+            table (str): "runs" or "energies"
+
+        Returns:
+            dict, array of each column, all of the same length
+        """
+        path_table, dtype = self._tables[table]
+        n = _table_size(path_table, dtype)
+        return {key: self._map(_path_column(path_table, key), dtype[key], n)
+                for key in dtype.names}
+
+    def _assemble(self, table, index=slice(None)):
+        """records of a table at index, as structured array"""
+        columns = self.get_columns(table)
+        dtype = self._tables[table][1]
+        parts = [columns[key][index] for key in dtype.names]
+        records = np.empty(len(parts[0]), dtype=dtype)
+        for key, x in zip(dtype.names, parts):
+            records[key] = x
+        return records
+
+    @property
+    def runs(self):
+        """structured array of run_dtype, all runs in the store"""
+        return self._assemble("runs")
+
+    @property
+    def energies(self):
+        """structured array of energy_dtype, energies of all runs"""
+        return self._assemble("energies")
+
+    def append(self, case, version, suffix, run_id, energies,
+               time=np.nan, walltime=np.nan, nprocs=0):
+        """append the result of one run
+
+        Args:
+            case (str): name of testcase
+            version (str): gap version
+            suffix (str): suffix of gap executable
+            run_id (str)
+            energies (structured array of energy_dtype): see read_eqp
+            time (float): time stamp of the run
+            walltime (float): running time in seconds
+            nprocs (int)
+
+        Raises:
+            ValueError if any key is too long for its field in run_dtype
+        """
+        keys = {"case": case, "version": version, "suffix": suffix or "", "run_id": run_id}
+        for key, value in keys.items():
+            if len(value.encode()) > run_dtype[key].itemsize:
+                raise ValueError("%s too long for the store (max %d bytes): %s"
+                                 % (key, run_dtype[key].itemsize, value))
+        energies = np.asarray(energies, dtype=energy_dtype)
+        with open(self._path_lock, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                offset = _align_table(self._path_energies, energy_dtype)
+                _align_table(self._path_runs, run_dtype)
+                run = np.array([(keys["case"], keys["version"], keys["suffix"], keys["run_id"],
+                                 time, walltime, nprocs, band_gap(energies["eks"]),
+                                 band_gap(energies["eqp"], reference=energies["eks"]),
+                                 offset, len(energies))], dtype=run_dtype)
+                _write_table(self._path_energies, energies)
+                _write_table(self._path_runs, run)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        _logger.info("stored %d energies of %s (%s%s) as run %s", len(energies),
+                     case, version, "-" + suffix if suffix else "", run_id)
+        return run[0]
+
+    def select(self, case=None, version=None, suffix=None, run_id=None):
+        """runs matching all given keys
+
+        Returns:
+            structured array of run_dtype
+        """
+        columns = self.get_columns("runs")
+        mask = np.ones(len(columns["case"]), dtype=bool)
+        for key, value in [("case", case), ("version", version),
+                           ("suffix", suffix), ("run_id", run_id)]:
+            if value is not None:
+                mask &= columns[key] == value.encode()
+        return self._assemble("runs", np.flatnonzero(mask))
+
+    def get_energies(self, run):
+        """energies of a run record"""
+        return self._assemble("energies", slice(run["offset"], run["offset"]+run["nrows"]))
+
+    def slice_runs(self, runs, ik, ib, key="eqp"):
+        """energy of one k-point and band across runs
+
+        Args:
+            runs (structured array of run_dtype)
+            ik (int) and ib (int): indices of k-point and band
+            key (str): "eqp" or "eks"
+
+        Returns:
+            array of the energy in each run, nan if the state is not in the run
+        """
+        columns = self.get_columns("energies")
+        rows = np.flatnonzero((columns["ik"] == ik) & (columns["ib"] == ib))
+        # the first matched row at or after the offset of each run
+        i = np.searchsorted(rows, runs["offset"])
+        found = i < len(rows)
+        found[found] = rows[i[found]] < (runs["offset"] + runs["nrows"])[found]
+        values = np.full(len(runs), np.nan)
+        values[found] = columns[key][rows[i[found]]]
+        return values
+
+    def latest(self, runs=None):
+        """latest run of each (case, version, suffix) among runs
+
+        Returns:
+            structured array of run_dtype, sorted by case, version and suffix
+        """
+        if runs is None:
+            runs = self.runs
+        if len(runs) == 0:
+            return runs
+        runs = runs[np.lexsort((runs["time"], runs["suffix"], runs["version"], runs["case"]))]
+        keys = np.stack([runs["case"], runs["version"].astype("S64"),
+                         runs["suffix"].astype("S64")])
+        last = np.ones(len(runs), dtype=bool)
+        last[:-1] = np.any(keys[:, 1:] != keys[:, :-1], axis=0)
+        return runs[last]
+
+
+# run itself as test, by python -m backend.store
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    import unittest as ut
+
+    class test_store(ut.TestCase):
+        def setUp(self):
+            self.path = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.path)
+
+        def test_read_eqp(self):
+            """read energies and skip comments"""
+            path_eqp = os.path.join(self.path, "case.eqpeV_GW")
+            with open(path_eqp, 'w') as h:
+                h.write("# ik ie Eks Ehf Eqp0 Eqp\n"
+                        "   1   1  -1.000  -2.000  -1.100  -1.200\n"
+                        "   1   2   1.000   3.000   1.500   1.600\n")
+            e = read_eqp(path_eqp)
+            self.assertListEqual([1, 2], list(e["ib"]))
+            self.assertListEqual([-1.2, 1.6], list(e["eqp"]))
+            self.assertAlmostEqual(2.8, band_gap(e["eqp"]))
+
+        def test_band_gap_shifted(self):
+            """occupation of QP states follows the KS energies"""
+            store = ResultStore(self.path)
+            e = np.array([(1, 1, -1.0, -1.2), (1, 2, 0.0, 0.3), (1, 3, 1.0, 1.6)],
+                         dtype=energy_dtype)
+            run = store.append("a", "2e", None, "run0", e)
+            self.assertAlmostEqual(1.0, run["gap_ks"])
+            self.assertAlmostEqual(1.3, run["gap_qp"])
+
+        def test_append_select(self):
+            """append runs and select the latest across versions"""
+            store = ResultStore(self.path)
+            e = np.array([(1, 1, -1.0, -1.5), (1, 2, 1.0, 2.0)], dtype=energy_dtype)
+            for i, version in enumerate(["2c", "2e", "2e"]):
+                store.append("gw_sp/1_diamond", version, None, "run%d" % i, e.copy(),
+                             time=float(i))
+                e["eqp"][1] += 1.0
+            store = ResultStore(self.path)
+            self.assertEqual(3, len(store.runs))
+            self.assertEqual(2, len(store.select(version="2e")))
+            latest = store.latest()
+            self.assertListEqual([b"run0", b"run2"], list(latest["run_id"]))
+            self.assertAlmostEqual(5.5, latest["gap_qp"][1])
+            self.assertListEqual([-1.5, 4.0], list(store.get_energies(latest[1])["eqp"]))
+
+        def test_long_keys(self):
+            """keys longer than the fields are refused"""
+            store = ResultStore(self.path)
+            e = np.zeros(1, dtype=energy_dtype)
+            self.assertRaises(ValueError, store.append, "gw_sp/1_diamond", "2e",
+                              "x" * 17, "run0", e)
+            self.assertEqual(0, len(store.runs))
+
+        def test_partial_record(self):
+            """entries left incomplete by an interrupted append are cut off"""
+            store = ResultStore(self.path)
+            e = np.array([(1, 1, -1.0, -1.5), (1, 2, 1.0, 2.0)], dtype=energy_dtype)
+            store.append("a", "2e", None, "run0", e)
+            with open(os.path.join(self.path, "energies", "eks.bin"), 'ab') as h:
+                h.write(b"12345678" * 3)
+            with open(os.path.join(self.path, "runs", "case.bin"), 'ab') as h:
+                h.write(b"c" * 64)
+            self.assertEqual(1, len(store.runs))
+            store.append("b", "2e", None, "run1", e)
+            self.assertEqual(4, len(store.energies))
+            self.assertListEqual([b"a", b"b"], list(store.runs["case"]))
+            run = store.select(case="b")[0]
+            self.assertListEqual([-1.5, 2.0], list(store.get_energies(run)["eqp"]))
+
+        def test_slice_runs(self):
+            """energy of one state across runs"""
+            store = ResultStore(self.path)
+            for i in range(3):
+                e = np.array([(1, 1, -1.0, -1.5 - i), (2, 1, 1.0, 2.0 + i)], dtype=energy_dtype)
+                store.append("a", "2e", None, "run%d" % i, e[:2-i//2])
+            runs = store.select(case="a")
+            self.assertListEqual([-1.5, -2.5, -3.5], list(store.slice_runs(runs, 1, 1)))
+            values = store.slice_runs(runs, 2, 1)
+            self.assertListEqual([2.0, 3.0], list(values[:2]))
+            self.assertTrue(np.isnan(values[2]))
+            self.assertTrue(np.isnan(store.slice_runs(runs, 3, 1)).all())
+
+        def test_concurrent_append(self):
+            """appends from several processes keep runs pointing to their own energies"""
+            nproc, nrun = 4, 50
+            pids = []
+            for p in range(nproc):
+                pid = os.fork()
+                if pid == 0:
+                    store = ResultStore(self.path)
+                    for i in range(nrun):
+                        e = np.zeros(10 + i, dtype=energy_dtype)
+                        e["ik"] = p
+                        e["ib"] = i
+                        store.append("case%d" % p, "2e", None, "run%d" % i, e)
+                    os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                self.assertEqual(0, os.waitpid(pid, 0)[1])
+            store = ResultStore(self.path)
+            self.assertEqual(nproc * nrun, len(store.runs))
+            for run in store.runs:
+                e = store.get_energies(run)
+                p, i = int(run["case"][4:]), int(run["run_id"][3:])
+                self.assertEqual(10 + i, len(e))
+                self.assertTrue(np.all(e["ik"] == p) and np.all(e["ib"] == i))
+    ut.main()
@@ -4,11 +4,14 @@ from __future__ import print_function
 import os
 import glob
 import json
+import time
 import subprocess as sp
 import datetime as dt
 from shutil import copy2
 
-from .utils import which, create_logger, intify, cleanup_tmp, get_divisors
+from .utils import which, create_logger, intify, cleanup_tmp, check_wien2k_version
+from .w2kstruct import analyze_kmesh
+from .store import ResultStore, read_eqp
 
 _logger = create_logger("testdriver", log=False, stream=True)
 del create_logger
@@ -77,6 +80,74 @@ def find_tests(include=None, exclude=None):
     _logger.info("all test cases to be run: %r", found)
     return found
 
+def analyze_tcname(tcname):
+    """predict k-points and useful numbers of processors of a test case
+    from its JSON and struct file, without any SCF run
+
+    Returns:
+        dict, see w2kstruct.analyze_kmesh
+    """
+    with open(os.path.join(initdir, tcname+".json"), 'r') as h:
+        d = json.load(h)
+    return analyze_kmesh(os.path.join(structdir, d["casename"] + ".struct"),
+                         kmesh_gw=d["gap"].get("kmesh_gw"),
+                         nkp=d["gap"].get("nkp"),
+                         kmesh_scf=d["scf"].get("kmesh_scf"))
+
+def get_gap_x(gap_version, gap_suffix=None, nprocs=1):
+    """name of gap executable, e.g. gap2e-mpi-ir4o.x"""
+    if gap_suffix is not None:
+        gap_suffix = "-{}".format(gap_suffix)
+    else:
+        gap_suffix = ''
+    return "gap" + gap_version + {1: ""}.get(nprocs, "-mpi") + "{}.x".format(gap_suffix)
+
+def _resolve(executable, executables=None):
+    """path of executable, from the map resolved by preflight if available"""
+    if executables is not None and executables.get(executable) is not None:
+        return executables[executable]
+    return which(executable)
+
+def preflight(testcases, gap_version, gap_suffix=None, nprocs=None,
+              any_nprocs=False, dry=False):
+    """resolve executables and check WIEN2k for all test cases before any compute
+
+    Args:
+        testcases (list of TestCase)
+        nprocs (int) and any_nprocs (bool): see TestCase.get_executables
+        dry (bool): only report the problems without raising
+
+    Returns:
+        dict, path of each needed executable, None if not found.
+        Pass it to TestCase.init and TestCase.run to use the resolved paths for the run
+
+    Raises:
+        ValueError if any executable is missing or WIEN2k is not qualified
+    """
+    needed = {}
+    errors = []
+    for tc in testcases:
+        for exe in tc.get_executables(gap_version, gap_suffix, nprocs, any_nprocs=any_nprocs):
+            needed.setdefault(exe, []).append(tc.tcname)
+        if tc.init_mode == "w":
+            require = tc.scf_args.get("version")
+            if not check_wien2k_version(require, version_w2k):
+                errors.append("%s requires WIEN2k %s, found %s"
+                              % (tc.tcname, require, version_w2k))
+    if version_w2k is None and any(tc.init_mode == "w" for tc in testcases):
+        errors.append("WIEN2k not found, check WIENROOT: %s" % w2kroot)
+    executables = {}
+    for exe, tcnames in needed.items():
+        executables[exe] = which(exe)
+        _logger.info("preflight: %s -> %s", exe, executables[exe])
+        if executables[exe] is None:
+            errors.append("%s is not found, needed by %s" % (exe, ", ".join(tcnames)))
+    for info in errors:
+        _logger.error("preflight: %s", info)
+    if errors and not dry:
+        raise ValueError("preflight failed: " + "; ".join(errors))
+    return executables
+
 
 class TestCase(object):
     """test case
@@ -107,9 +178,22 @@ class TestCase(object):
             _logger.info(">> %10s : %r", k, v)
         self._w2k_nprocs = self.scf_args.pop("nprocs", 1)
         self.gap_args = d.pop("gap")
+        # struct file at self._struct
+        self._struct = os.path.join(structdir, self.casename + ".struct")
+        self.kmesh_info = analyze_kmesh(self._struct,
+                                        kmesh_gw=self.gap_args.get("kmesh_gw"),
+                                        nkp=self.gap_args.get("nkp"),
+                                        kmesh_scf=self.scf_args.get("kmesh_scf"))
+        for w in self.kmesh_info["warnings"]:
+            _logger.warning(">> %s", w)
+        _logger.info(">> predicted nkp %r, irreducible %r, irreducible in SCF %r",
+                     self.kmesh_info["nkp"], self.kmesh_info["nirkp"],
+                     self.kmesh_info["nirkp_scf"])
+        if not self.gap_args.get("nkp"):
+            self.gap_args["nkp"] = self.kmesh_info["nkp"]
         self._gap_nprocs = self.gap_args.pop("nprocs", None)
         if self._gap_nprocs is None:
-            self._gap_nprocs = get_divisors(self.gap_args["nkp"])
+            self._gap_nprocs = self.kmesh_info["nprocs"] or [1,]
         _logger.info(">> gap initialization parameters:")
         for k, v in self.gap_args.items():
             _logger.info(">> %10s : %r", k, v)
@@ -118,8 +202,6 @@ class TestCase(object):
         self._init_mode = init_mode
         # prepare all inputs file under self._inputdir
         self._inputdir = os.path.join(inputsdir, self._tcname)
-        # struct file at self._struct
-        self._struct = os.path.join(structdir, self.casename + ".struct")
         # wien2k calculation in self._wiendir
         self._wiendir = os.path.join(self._inputdir, self.casename)
         # gap inputs file in self._gapdir
@@ -130,16 +212,18 @@ class TestCase(object):
         workspace = os.path.join(rootdir, workspace)
         self._workspace = os.path.join(workspace, self._tcname)
 
-    def init(self, gap_version, dry=False):
+    def init(self, gap_version, dry=False, executables=None):
         """initialize test case
 
         Args:
             dry (bool) : fake run for workflow test
+            executables (dict) : paths of executables resolved by preflight
         """
         if not self._init_mode:
             return
         gap_init = "gap" + gap_version + "_init"
-        if which(gap_init) is None and not dry:
+        path_init = _resolve(gap_init, executables)
+        if path_init is None and not dry:
             info = "gap_init for version %s is not found: %s" % (gap_version, gap_init)
             _logger.error(info)
             raise ValueError(info)
@@ -147,43 +231,34 @@ class TestCase(object):
         self._switch_to_wien_case()
         if not dry:
             if self._init_mode == "w":
-                self._init_w2k_scf()
-                self._run_w2k_scf()
+                self._init_w2k_scf(_resolve("init_lapw", executables) or "init_lapw")
+                self._run_w2k_scf(_resolve(self._get_scf_exe(), executables))
             if self._init_mode in ["g", "w"]:
-                self._run_gap_init(gap_init)
+                self._run_gap_init(path_init)
         self._switch_to_rootdir()
 
     def run(self, gap_version, gap_suffix=None,
-            nprocs=None, dry=False):
+            nprocs=None, dry=False, executables=None, run_id=None):
         """start test case
 
         Args:
             maxnprocs (int)
             dry (bool) : fake run for workflow test
+            executables (dict) : paths of executables resolved by preflight
+            run_id (str) : ID to store the results, default to the time stamp
+
+        Returns:
+            bool, False if the case is skipped or gap fails
         """
         # quickly return if in initialization mode
         if self._init_mode:
-            return
-        gap_nprocs = [self._gap_nprocs,]
-        if isinstance(self._gap_nprocs, list):
-            gap_nprocs = self._gap_nprocs
-        gap_nprocs.sort(reverse=True)
-        if nprocs is None:
-            nprocs = gap_nprocs[0]
-        else:
-            for x in gap_nprocs:
-                if x <= nprocs:
-                    nprocs = x
-                    break
+            return True
+        nprocs = self.get_gap_nprocs(nprocs)
         _logger.info(">> using %d processors", nprocs)
-        _logger.info(">>   from %r", gap_nprocs)
-        if gap_suffix is not None:
-            gap_suffix = "-{}".format(gap_suffix)
-        else:
-            gap_suffix = ''
-        gap_x = "gap" + gap_version + {1: ""}.get(nprocs, "-mpi") \
-                + "{}.x".format(gap_suffix)
-        if which(gap_x) is None and not dry:
+        _logger.info(">>   from %r", self.gap_nprocs)
+        gap_x = get_gap_x(gap_version, gap_suffix, nprocs)
+        path_x = _resolve(gap_x, executables)
+        if path_x is None and not dry:
             info = "gap.x for version %s is not found: %s" % (gap_version, gap_x)
             _logger.error(info)
             raise ValueError(info)
@@ -192,15 +267,84 @@ class TestCase(object):
         except IOError:
             self.logger.warning("Test case %s has been skipped.",
                                  self._tcname)
-            return
+            return False
         self._switch_to_workspace_case()
+        success = True
         if not dry:
-            self._run_gap(gap_x, nprocs)
+            success = self._run_gap(path_x, nprocs, gap_version, gap_suffix,
+                                    mpirun=_resolve("mpirun", executables) or "mpirun",
+                                    run_id=run_id)
         self._switch_to_rootdir()
+        return success
+
+    @property
+    def tcname(self):
+        """str, name of testcase"""
+        return self._tcname
+
+    @property
+    def init_mode(self):
+        """str, "w" for WIEN2k and GAP initialization, "g" for GAP only. False for running"""
+        return self._init_mode
+
+    @property
+    def gap_nprocs(self):
+        """list, useful numbers of processors to run gap, in descending order"""
+        gap_nprocs = [self._gap_nprocs,]
+        if isinstance(self._gap_nprocs, list):
+            gap_nprocs = self._gap_nprocs
+        return sorted(gap_nprocs, reverse=True)
+
+    def get_gap_nprocs(self, nprocs=None):
+        """the largest useful number of processors not exceeding nprocs"""
+        gap_nprocs = self.gap_nprocs
+        if nprocs is None:
+            return gap_nprocs[0]
+        for x in gap_nprocs:
+            if x <= nprocs:
+                return x
+        return nprocs
+
+    def get_executables(self, gap_version, gap_suffix=None, nprocs=None, any_nprocs=False):
+        """executables needed by init or run of the case
+
+        Args:
+            nprocs (int): maximal number of processors
+            any_nprocs (bool): include executables for all useful numbers of processors
+                not exceeding nprocs, when the number is decided later
+
+        Returns:
+            list
+        """
+        if self._init_mode:
+            exes = ["gap" + gap_version + "_init",]
+            if self._init_mode == "w":
+                exes.extend(["init_lapw", self._get_scf_exe()])
+            return exes
+        if any_nprocs:
+            all_nprocs = [x for x in self.gap_nprocs if nprocs is None or x <= nprocs] or [1,]
+        else:
+            all_nprocs = [self.get_gap_nprocs(nprocs),]
+        exes = []
+        for x in all_nprocs:
+            gap_x = get_gap_x(gap_version, gap_suffix, x)
+            if gap_x not in exes:
+                exes.append(gap_x)
+        if max(all_nprocs) > 1:
+            exes.append("mpirun")
+        return exes
+
+    def _get_scf_exe(self):
+        exe = self.scf_args.get("exe", None)
+        if exe is None:
+            exe = "run_lapw"
+            if self.is_sp:
+                exe = "runsp_lapw"
+        return exe
 
-    def _init_w2k_scf(self):
+    def _init_w2k_scf(self, init_lapw="init_lapw"):
         """initialze wien2k input files"""
-        initlapw = ["init_lapw", "-b", "-rkmax", str(self.rkmax),]
+        initlapw = [init_lapw, "-b", "-rkmax", str(self.rkmax),]
         for key in ["ecut", "vxc"]:
             initlapw.extend(["-" + key, str(self.scf_args.get(key))])
         if self.is_sp:
@@ -242,12 +386,13 @@ class TestCase(object):
             _logger.error(info)
 
     def _run_w2k_scf(self, exe=None):
-        """run wien2k calculation"""
-        exe = self.scf_args.get("exe", None)
+        """run wien2k calculation
+
+        Args:
+            exe (str): path of the SCF script, default to the one set in scf by name
+        """
         if exe is None:
-            exe = "run_lapw"
-            if self.is_sp:
-                exe = "runsp_lapw"
+            exe = self._get_scf_exe()
         ec = self.scf_args.get("ec")
         runlapw = [exe, "-ec", "%15.12f" % ec]
         try:
@@ -257,22 +402,33 @@ class TestCase(object):
             info = "fail to run SCF for %s" % self._tcname
             _logger.error(info)
 
-    def _run_gap(self, gap_x, nprocs, cleanup=True):
+    def _run_gap(self, gap_x, nprocs, gap_version, gap_suffix=None, cleanup=True,
+                 mpirun="mpirun", run_id=None):
         """run gap calculation
 
         Args:
             gap_x (str): gap.x executable
+            mpirun (str): mpirun executable
+            gap_version (str), gap_suffix (str) and run_id (str): keys to store the results.
+                run_id defaults to the time stamp
+
+        Returns:
+            bool, True if gap finishes successfully
         """
+        success = False
         rungap = [gap_x,]
         if nprocs > 1:
-            rungap = ["mpirun", "-np", str(nprocs)] + rungap
+            rungap = [mpirun, "-np", str(nprocs)] + rungap
+        start = dt.datetime.today()
+        if run_id is None:
+            run_id = start.strftime("%y%m%d-%H%M%S")
         try:
             self.logger.info("> begin to run case: %s", self._tcname)
             self.logger.info(">> command %s", " ".join(rungap))
-            with open("gaptest_{}.log".format(dt.datetime.today().strftime("%y%m%d-%H%M%S")),
-                      'w') as h:
+            with open("gaptest_{}.log".format(run_id), 'w') as h:
                 proc = sp.Popen(rungap, stdout=h, stderr=sp.STDOUT)
-                proc.wait()
+                if proc.wait() != 0:
+                    raise sp.CalledProcessError(proc.returncode, rungap)
         except sp.CalledProcessError:
             info = "> fail for case: %s" % self._tcname
             self.logger.error(info)
@@ -281,13 +437,32 @@ class TestCase(object):
             info = "> finished case successfully :)"
             self.logger.info(info)
             _logger.info(info)
-            # TODO analyse data when finished successfully
+            walltime = (dt.datetime.today() - start).total_seconds()
+            self._store_results(gap_version, gap_suffix, run_id, walltime, nprocs)
+            success = True
         finally:
             if cleanup:
                 self.logger.info("> clean up large files in tmp")
                 for ext in ["eps", "mwm", "vmat", "sxc_nn", "sx_nn"]:
                     self.logger.info(">> cleaning %s", ext)
                     cleanup_tmp(ext)
+        return success
+
+    def _store_results(self, gap_version, gap_suffix, run_id, walltime, nprocs):
+        """parse the QP energies in the workspace and append them to the result store"""
+        eqp = "{}.eqpeV_{}".format(self.casename, self.task.upper())
+        if not os.path.isfile(eqp):
+            self.logger.warning(">> %s not found, results not stored", eqp)
+            return
+        store = ResultStore(refersdir)
+        try:
+            run = store.append(self._tcname, gap_version, gap_suffix, run_id, read_eqp(eqp),
+                               time=time.time(), walltime=walltime, nprocs=nprocs)
+        except ValueError as err:
+            self.logger.error(">> results not stored: %s", err)
+            return
+        self.logger.info(">> KS gap %.4f eV, QP gap %.4f eV, %.1f seconds",
+                         run["gap_ks"], run["gap_qp"], walltime)
 
     def _switch_to_workspace_case(self):
         os.chdir(self._workspace)
@@ -36,11 +36,68 @@ def gap_parser(docstr):
                    help="append mode for logger")
     p.add_argument("--force", dest="force_restart", action="store_true",
                    help="forcing restart an existing testcase")
+    p.add_argument("--id", dest="run_id", type=str, default=None,
+                   help="run ID to store the results, default to the time stamp of running gap")
+    return p
+
+def daemon_parser(docstr):
+    """parser of the local runner daemon and its client"""
+    p = ArgumentParser(description=docstr,
+                       formatter_class=RawDescriptionHelpFormatter)
+    p.add_argument("-s", dest="socket", type=str, default=None,
+                   help="path to the Unix socket of the daemon")
+    sub = p.add_subparsers(dest="cmd")
+    sub.required = True
+    ps = sub.add_parser("serve", help="start the daemon")
+    ps.add_argument("-c", dest="cores", type=int, default=None,
+                    help="number of cores owned by the daemon, default to all cores")
+    ps.add_argument("-m", dest="mem", type=float, default=None,
+                    help="memory in GB owned by the daemon, default to no limit")
+    pq = sub.add_parser("submit", help="submit test cases")
+    pq.add_argument(dest="gap_version", type=str,
+                    help="version of gap")
+    pq.add_argument("-x", dest="exclude", type=str, default=None, nargs="+",
+                    help="testcases to exclude, default to None")
+    pq.add_argument("-i", dest="include", type=str, default=None, nargs="+",
+                    help="testcases to include, default to include all cases")
+    pq.add_argument("-n", type=int, dest="nprocs", default=None,
+                    help="maximal number of processors for each case")
+    pq.add_argument("-m", dest="mem", type=float, default=0.0,
+                    help="memory in GB required by each case")
+    pq.add_argument("-u", dest="submitter", type=str, default=None,
+                    help="name of submitter for fair share, default to user name")
+    pq.add_argument("--gf", dest="gap_suffix", type=str, default=None,
+                    help="suffix of gap executable, e.g. ir4o in gap2e-mpi-ir4o.x")
+    pq.add_argument("--dry", action="store_true", help="dry run for test use")
+    pt = sub.add_parser("status", help="show status of submissions")
+    pt.add_argument(dest="sid", type=int, default=None, nargs="?",
+                    help="id of submission, default to all")
+    pc = sub.add_parser("cancel", help="cancel queued cases of a submission")
+    pc.add_argument(dest="sid", type=int, help="id of submission")
+    sub.add_parser("shutdown", help="stop the daemon after running cases finish")
+    return p
+
+def report_parser(docstr):
+    """parser of the report of stored results"""
+    p = ArgumentParser(description=docstr,
+                       formatter_class=RawDescriptionHelpFormatter)
+    p.add_argument("-c", dest="cases", type=str, default=None, nargs="+",
+                   help="testcases to report, default to all stored cases")
+    p.add_argument("-v", dest="versions", type=str, default=None, nargs="+",
+                   help="gap versions to report, with suffix as 2e-ir4o. Default to all")
+    p.add_argument("-k", dest="key", type=str, default="gap_qp",
+                   choices=["gap_qp", "gap_ks", "walltime"],
+                   help="quantity to report")
+    p.add_argument("-r", dest="store", type=str, default=None,
+                   help="directory of result store, default to refs")
     return p
 
 def which(executable):
     """emulation of which function in shutil of Python3
 
+    The search is done in-process. Nothing is cached, the map returned by
+    testcase.preflight serves as the cache of one driver run.
+
     Args:
         executable (str)
 
@@ -48,9 +105,13 @@ def which(executable):
         str, if executable is found in PATH
         None otherwise
     """
-    path = os.popen("which %s 2> /dev/null" % executable).read().strip()
-    if path:
-        return path
+    dirs = os.environ.get("PATH", "").split(os.pathsep)
+    if os.path.dirname(executable):
+        dirs = ['']
+    for d in dirs:
+        f = os.path.join(d, executable)
+        if os.path.isfile(f) and os.access(f, os.X_OK):
+            return os.path.abspath(f)
     return None
 
 
@@ -115,18 +176,28 @@ def intify(strlist):
             new.append(x)
     return new
 
-def check_wien2k_version(require_version):
+def check_wien2k_version(require_version, version=None):
     """check if version is qualified
 
     Args:
-        require_version (str)
+        require_version (str): e.g. "14.2" for 14.2 only, "14" for any 14.x,
+            ">=14.2" for 14.2 or later. None for any version.
+        version (str): the installed WIEN2k version
 
     Returns:
         bool
     """
     if require_version is None:
         return True
-    return False
+    if version is None:
+        return False
+    require_version = str(require_version).strip()
+    later = require_version.startswith(">=")
+    req = tuple(int(x) for x in re.findall(r"\d+", require_version))
+    ver = tuple(int(x) for x in re.findall(r"\d+", version))
+    if later:
+        return ver >= req
+    return ver[:len(req)] == req
 
 def cleanup_tmp(ext):
     """clean up large files in tmp directory generated from GAP2 calculation
@@ -167,4 +238,38 @@ if __name__ == "__main__":
             self.assertListEqual([1, 3, 9], get_divisors(9, ascend=True))
             self.assertListEqual([216, 108, 72, 54, 36, 27, 24, 18, 12, 9, 8, 6, 4, 3, 2, 1],
                                  get_divisors(216))
+
+        def test_check_wien2k_version(self):
+            """check required WIEN2k version"""
+            self.assertTrue(check_wien2k_version(None, None))
+            self.assertFalse(check_wien2k_version("14.2", None))
+            self.assertTrue(check_wien2k_version("14.2", "14.2"))
+            self.assertTrue(check_wien2k_version("14", "14.2"))
+            self.assertFalse(check_wien2k_version("14.2", "19.1"))
+            self.assertTrue(check_wien2k_version(">=14.2", "19.1"))
+            self.assertFalse(check_wien2k_version(">=19.2", "19.1"))
+
+        def test_which(self):
+            """find executables in PATH"""
+            self.assertIsNotNone(which("sh"))
+            self.assertIsNone(which("no-such-executable-gap2.x"))
+
+        def test_which_removed(self):
+            """removed executables are not found anymore"""
+            import shutil
+            import tempfile
+            d = tempfile.mkdtemp()
+            exe = os.path.join(d, "gap2x-test.x")
+            with open(exe, 'w') as h:
+                h.write("#!/bin/sh\n")
+            os.chmod(exe, 0o755)
+            path = os.environ.get("PATH", "")
+            os.environ["PATH"] = d + os.pathsep + path
+            try:
+                self.assertEqual(exe, which("gap2x-test.x"))
+                os.unlink(exe)
+                self.assertIsNone(which("gap2x-test.x"))
+            finally:
+                os.environ["PATH"] = path
+                shutil.rmtree(d)
     ut.main()
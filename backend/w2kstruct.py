@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""WIEN2k struct file and k-mesh analyzer"""
+# pylint: disable=R0205
+from __future__ import print_function
+import re
+import numpy as np
+
+from .utils import create_logger, get_divisors
+
+_logger = create_logger("w2kstruct", log=False, stream=True)
+
+# primitive lattice vectors in fractional coordinates of the conventional cell (rows).
+# For R lattice WIEN2k gives positions and symmetry operations
+# in the rhombohedral basis already, hence no transformation is needed.
+_CENTERINGS = {
+    "P": np.identity(3),
+    "H": np.identity(3),
+    "R": np.identity(3),
+    "F": np.array([[0.0, 0.5, 0.5],
+                   [0.5, 0.0, 0.5],
+                   [0.5, 0.5, 0.0]]),
+    "B": np.array([[-0.5, 0.5, 0.5],
+                   [0.5, -0.5, 0.5],
+                   [0.5, 0.5, -0.5]]),
+    "CXY": np.array([[0.5, -0.5, 0.0],
+                     [0.5, 0.5, 0.0],
+                     [0.0, 0.0, 1.0]]),
+    "CXZ": np.array([[0.5, 0.0, -0.5],
+                     [0.0, 1.0, 0.0],
+                     [0.5, 0.0, 0.5]]),
+    "CYZ": np.array([[1.0, 0.0, 0.0],
+                     [0.0, 0.5, -0.5],
+                     [0.0, 0.5, 0.5]]),
+    }
+
+_POS_PAT = re.compile(r"X=\s*([-\d\.]+)\s*Y=\s*([-\d\.]+)\s*Z=\s*([-\d\.]+)")
+_MULT_PAT = re.compile(r"MULT=\s*(\d+)")
+_RMT_PAT = re.compile(r"RMT=\s*([\d\.]+)")
+_ZNUC_PAT = re.compile(r"Z:\s*([\d\.]+)")
+
+_structs = {}
+
+
+class W2kStruct(object):
+    """WIEN2k master input file, i.e. case.struct
+
+    Only the lattice, atoms and symmetry operations are extracted.
+
+    Args:
+        path_struct (str) : path to the struct file
+    """
+    def __init__(self, path_struct):
+        with open(path_struct, 'r') as h:
+            self._lines = [l.rstrip('\n') for l in h.readlines()]
+        self.title = self._lines[0].strip()
+        self.lattice = self._lines[1][:4].strip()
+        self.nat = int(self._lines[1][27:30])
+        self.latt_params = np.array([float(self._lines[3][10*i:10*(i+1)]) for i in range(6)])
+        self.atoms = []
+        self.rotations = None
+        self.translations = None
+        self._read_atoms()
+        if self.lattice not in _CENTERINGS:
+            raise ValueError("unsupported lattice type %s in %s" % (self.lattice, path_struct))
+
+    def _read_atoms(self):
+        """extract atoms and symmetry operations"""
+        i = 4
+        for _ in range(self.nat):
+            positions = [_POS_PAT.search(self._lines[i]).groups(),]
+            mult = int(_MULT_PAT.search(self._lines[i+1]).group(1))
+            i += 2
+            for _ in range(mult - 1):
+                positions.append(_POS_PAT.search(self._lines[i]).groups())
+                i += 1
+            l = self._lines[i]
+            self.atoms.append({"name": l[:10].strip(),
+                               "positions": np.array(positions, dtype=float),
+                               "rmt": float(_RMT_PAT.search(l).group(1)),
+                               "z": float(_ZNUC_PAT.search(l).group(1))})
+            # skip the local rotation matrix
+            i += 4
+        nops = int(self._lines[i].split()[0])
+        i += 1
+        rots = np.zeros((nops, 3, 3), dtype=int)
+        trans = np.zeros((nops, 3))
+        for iop in range(nops):
+            for j in range(3):
+                l = self._lines[i+j]
+                rots[iop, j, :] = [int(l[2*k:2*(k+1)]) for k in range(3)]
+                trans[iop, j] = float(l[6:17])
+            i += 4
+        self.rotations = rots
+        self.translations = trans
+
+    @property
+    def nops(self):
+        """int, number of symmetry operations"""
+        return len(self.rotations)
+
+    @property
+    def kpt_rotations(self):
+        """array (nops,3,3), rotations acting on k in the primitive reciprocal basis
+
+        A symmetry operation x' = R x + t in the conventional fractional coordinates
+        transforms k in the primitive reciprocal basis by C R^T C^-1,
+        where rows of C are the primitive vectors in the conventional basis.
+        """
+        cen = _CENTERINGS[self.lattice]
+        rots = np.einsum("ab,ocb,cd->oad", cen, self.rotations, np.linalg.inv(cen))
+        irots = np.rint(rots).astype(int)
+        if not np.allclose(rots, irots, atol=1.0E-6):
+            raise ValueError("non-integer rotation in primitive basis, check the struct file")
+        return irots
+
+    def reduce_kmesh(self, kmesh, time_reversal=True):
+        """reduce a Gamma-centered k-mesh to the irreducible k-points
+
+        Args:
+            kmesh (3-member list): divisions along the primitive reciprocal vectors
+            time_reversal (bool): treat k and -k as equivalent
+
+        Returns:
+            array (nirkp,3) of integer indices of irreducible k-points and
+            array (nirkp,) of their weights, i.e. number of k-points in the star
+        """
+        return reduce_kmesh(self.kpt_rotations, kmesh, time_reversal=time_reversal)
+
+
+def reduce_kmesh(rotations, kmesh, time_reversal=True):
+    """reduce a Gamma-centered k-mesh by the rotations acting on k
+
+    Rotations that do not map the mesh onto itself are discarded.
+    All mesh points are mapped in one go, and the smallest linear index
+    in the star is used as the representative.
+
+    Args:
+        rotations (array (nops,3,3)): integer rotations in the reciprocal basis of kmesh
+        kmesh (3-member list): divisions along the reciprocal vectors
+        time_reversal (bool): treat k and -k as equivalent
+
+    Returns:
+        array (nirkp,3) and array (nirkp,), see W2kStruct.reduce_kmesh
+    """
+    n = np.array(kmesh, dtype=int)
+    rots = np.asarray(rotations, dtype=int)
+    if time_reversal:
+        rots = np.concatenate([rots, -rots])
+    # rotations in the basis of mesh indices, i.e. diag(n) R diag(1/n)
+    rots_idx = rots * n[None, :, None] / n[None, None, :]
+    keep = np.all(np.isclose(rots_idx, np.rint(rots_idx)), axis=(1, 2))
+    if not np.all(keep):
+        _logger.debug("%d operations incompatible with kmesh %r discarded",
+                      np.count_nonzero(~keep), list(kmesh))
+    rots_idx = np.rint(rots_idx[keep]).astype(int)
+    idx = np.indices(n).reshape(3, -1).T
+    images = np.mod(np.einsum("oab,kb->oka", rots_idx, idx), n)
+    linear = (images[:, :, 0] * n[1] + images[:, :, 1]) * n[2] + images[:, :, 2]
+    reps, weights = np.unique(linear.min(axis=0), return_counts=True)
+    return idx[reps], weights
+
+
+def get_struct(path_struct):
+    """get the W2kStruct object of path_struct. The parsed object is cached."""
+    if path_struct not in _structs:
+        _structs[path_struct] = W2kStruct(path_struct)
+    return _structs[path_struct]
+
+
+def analyze_kmesh(path_struct, kmesh_gw=None, nkp=None, kmesh_scf=None):
+    """predict the numbers of k-points and useful numbers of processors before any SCF
+
+    Args:
+        path_struct (str): path to struct file
+        kmesh_gw (3-member list): k-mesh for GW
+        nkp (int): number of k-points for GW set in the case JSON
+        kmesh_scf (3-member list): k-mesh for SCF
+
+    Returns:
+        dict with keys
+
+        - nkp: number of k-points passed to gap_init, i.e. nkp if set,
+          otherwise the number of k-points in the full GW k-mesh
+        - nirkp: number of irreducible GW k-points
+        - nirkp_scf: number of irreducible SCF k-points
+        - nprocs: divisors of nkp, and of nirkp if kmesh_gw is consistent with nkp,
+          in descending order
+        - warnings: list of inconsistencies found
+
+        A missing or unsupported struct file is reported in warnings,
+        and nprocs are then the divisors of nkp only.
+    """
+    result = {"nkp": nkp, "nirkp": None, "nirkp_scf": None,
+              "nprocs": None, "warnings": []}
+    try:
+        st = get_struct(path_struct)
+        if kmesh_gw is not None:
+            nkp_mesh = int(np.prod(kmesh_gw))
+            result["nirkp"] = len(st.reduce_kmesh(kmesh_gw)[1])
+            if not nkp:
+                result["nkp"] = nkp_mesh
+            elif nkp != nkp_mesh:
+                result["warnings"].append("nkp = %d inconsistent with kmesh_gw %r (%d k-points),"
+                                          " nprocs planned for nkp"
+                                          % (nkp, list(kmesh_gw), nkp_mesh))
+        if kmesh_scf is not None:
+            result["nirkp_scf"] = len(st.reduce_kmesh(kmesh_scf)[1])
+    except (IOError, ValueError, IndexError, AttributeError) as err:
+        result["nirkp"] = None
+        result["nirkp_scf"] = None
+        result["warnings"].append("struct file %s not analyzed: %s" % (path_struct, err))
+    if result["nkp"]:
+        nprocs = set(get_divisors(result["nkp"]))
+        if result["nirkp"] and not result["warnings"]:
+            nprocs.update(get_divisors(result["nirkp"]))
+        result["nprocs"] = sorted(nprocs, reverse=True)
+    return result
+
+# run itself as test, by python -m backend.w2kstruct
+if __name__ == "__main__":
+    import os
+    import unittest as ut
+
+    _structdir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "struct_files")
+
+    class test_w2kstruct(ut.TestCase):
+        def test_read_struct(self):
+            """read lattice, atoms and symmetry operations"""
+            st = W2kStruct(os.path.join(_structdir, "hBN.struct"))
+            self.assertEqual("H", st.lattice)
+            self.assertEqual(2, st.nat)
+            self.assertEqual(12, st.nops)
+            self.assertListEqual([0, -1, 0], list(st.rotations[1, 0]))
+            self.assertAlmostEqual(1.35, st.atoms[1]["rmt"])
+
+        def test_reduce_kmesh(self):
+            """number of irreducible k-points of fcc and hexagonal lattices"""
+            st = W2kStruct(os.path.join(_structdir, "diamond.struct"))
+            for kmesh, nirkp in [([2, 2, 2], 3), ([4, 4, 4], 8), ([6, 6, 6], 16),
+                                 ([8, 8, 8], 29)]:
+                weights = st.reduce_kmesh(kmesh)[1]
+                self.assertEqual(nirkp, len(weights))
+                self.assertEqual(np.prod(kmesh), weights.sum())
+            st = W2kStruct(os.path.join(_structdir, "hBN.struct"))
+            self.assertEqual(3, len(st.reduce_kmesh([3, 3, 1])[1]))
+            self.assertEqual(28, len(st.reduce_kmesh([6, 6, 6])[1]))
+
+        def test_analyze_kmesh(self):
+            """nprocs follow the nkp passed to gap_init"""
+            path_struct = os.path.join(_structdir, "hBN.struct")
+            info = analyze_kmesh(path_struct, kmesh_gw=[3, 3, 1])
+            self.assertEqual(9, info["nkp"])
+            self.assertListEqual([9, 3, 1], info["nprocs"])
+            info = analyze_kmesh(path_struct, kmesh_gw=[3, 3, 1], nkp=6)
+            self.assertEqual(6, info["nkp"])
+            self.assertListEqual([6, 3, 2, 1], info["nprocs"])
+            self.assertEqual(1, len(info["warnings"]))
+
+        def test_analyze_no_struct(self):
+            """missing struct falls back to the divisors of nkp"""
+            info = analyze_kmesh(os.path.join(_structdir, "none.struct"), kmesh_gw=[2, 2, 2], nkp=8)
+            self.assertEqual(8, info["nkp"])
+            self.assertIsNone(info["nirkp"])
+            self.assertListEqual([8, 4, 2, 1], info["nprocs"])
+            self.assertEqual(1, len(info["warnings"]))
+    ut.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""local runner daemon of GAP2 testfarm, sharing the cores of a node among submitters
+
+start the daemon
+    python gap_daemon.py serve -c 64
+submit cases and check the status
+    python gap_daemon.py submit 2e --gf ir4o -i gw_sp
+    python gap_daemon.py status
+"""
+from __future__ import print_function
+import getpass
+
+from backend.utils import daemon_parser
+from backend.daemon import serve, request, default_socket
+
+
+def gap_daemon():
+    """run the daemon or send request to it"""
+    args = daemon_parser(__doc__).parse_args()
+    path_socket = args.socket or default_socket
+    try:
+        if args.cmd == "serve":
+            serve(cores=args.cores, mem=args.mem, path_socket=path_socket)
+            return
+        if args.cmd == "submit":
+            response = request(path_socket, cmd="submit", gap_version=args.gap_version,
+                               gap_suffix=args.gap_suffix, include=args.include,
+                               exclude=args.exclude, nprocs=args.nprocs, mem=args.mem,
+                               submitter=args.submitter or getpass.getuser(), dry=args.dry)
+        elif args.cmd in ["status", "cancel"]:
+            response = request(path_socket, cmd=args.cmd, sid=args.sid)
+        else:
+            response = request(path_socket, cmd=args.cmd)
+    except ValueError as err:
+        raise SystemExit(err)
+    if "error" in response:
+        raise SystemExit(response["error"])
+    if args.cmd == "submit":
+        print("submission {:d}: {:d} cases in {:s}".format(response["sid"],
+                                                          len(response["cases"]),
+                                                          response["workspace"]))
+    elif args.cmd == "status":
+        print("cores: {:d} free of {:d}".format(response["free_cores"], response["cores"]))
+        print("jobs:", ", ".join("{} {}".format(v, k) for k, v in response["summary"].items()))
+        for j in response["jobs"]:
+            elapsed = j["elapsed"]
+            if elapsed is not None:
+                elapsed = "{:.1f}s".format(elapsed)
+            gaps = ""
+            if j["gap_qp"] is not None:
+                gaps = "KS {:.4f} QP {:.4f} eV in {:.1f}s".format(j["gap_ks"], j["gap_qp"],
+                                                                j["walltime"])
+            print("{:4d} {:4d} {:10s} {:30s} {:10s} np {!s:>4} rc {!s:>4} {!s:>8} {}"
+                  .format(j["jid"], j["sid"], j["submitter"], j["tcname"], j["state"],
+                          j["nprocs"], j["returncode"], elapsed, gaps))
+    else:
+        print(response)
+
+
+if __name__ == "__main__":
+    gap_daemon()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""report results of the latest run of each case across GAP versions from the result store
+"""
+from __future__ import print_function
+
+from backend.utils import report_parser
+from backend.testcase import refersdir
+from backend.store import ResultStore
+
+
+def gap_report():
+    """print a table of cases against versions"""
+    args = report_parser(__doc__).parse_args()
+    store = ResultStore(args.store or refersdir)
+    runs = store.latest()
+    labels = [(v + b"-" + s if s else v).decode() for v, s in zip(runs["version"], runs["suffix"])]
+    versions = args.versions or sorted(set(labels))
+    cases = args.cases or sorted(set(c.decode() for c in runs["case"]))
+    table = {(c.decode(), l): r[args.key] for c, l, r in zip(runs["case"], labels, runs)}
+    print("{:30s}".format("case") + "".join("{:>14s}".format(v) for v in versions))
+    for c in cases:
+        print("{:30s}".format(c) + "".join("{:14.4f}".format(table[(c, v)])
+                                           if (c, v) in table else "{:>14s}".format("-")
+                                           for v in versions))
+
+
+if __name__ == "__main__":
+    gap_report()
@@ -3,9 +3,10 @@
 """initialize and run the testfarm of GAP2 code for many-body perturbation calculation
 """
 from __future__ import print_function
+import sys
 
 from backend.utils import create_logger, gap_parser
-from backend.testcase import TestCase, find_tests
+from backend.testcase import TestCase, find_tests, analyze_tcname, preflight
 
 __project__ = "gap2-testcases"
 __version__ = "0.0.3"
@@ -21,21 +22,36 @@ def gap_test():
     if args.preview:
         print("Preview mode:")
         for i, tc in enumerate(testcases):
-            print("{:3d}: {:s}".format(i+1, tc))
+            info = analyze_tcname(tc)
+            print("{:3d}: {:30s} nkp {!s:>4} irr {!s:>4} scf-irr {!s:>4} nprocs {}"
+                  .format(i+1, tc, info["nkp"], info["nirkp"], info["nirkp_scf"],
+                          info["nprocs"]))
+            for w in info["warnings"]:
+                print("     warning:", w)
         return
     if args.init:
         init_mode = "w"
     if args.init_gap:
         init_mode = "g"
 
+    tcs = []
     for x in testcases:
         logger.info("Found test: %s", x)
-        tc = TestCase(x, logger, workspace=args.workspace,
-                      init_mode=init_mode,
-                      force_restart=args.force_restart)
-        tc.init(args.gap_version, dry=args.dry)
-        tc.run(args.gap_version, args.gap_suffix, nprocs=args.nprocs,
-               dry=args.dry)
+        tcs.append(TestCase(x, logger, workspace=args.workspace,
+                            init_mode=init_mode,
+                            force_restart=args.force_restart))
+    # resolve all executables once and fail before any compute
+    executables = preflight(tcs, args.gap_version, args.gap_suffix, nprocs=args.nprocs,
+                            dry=args.dry)
+    failed = []
+    for tc in tcs:
+        tc.init(args.gap_version, dry=args.dry, executables=executables)
+        if not tc.run(args.gap_version, args.gap_suffix, nprocs=args.nprocs,
+                      dry=args.dry, executables=executables, run_id=args.run_id):
+            failed.append(tc.tcname)
+    if failed:
+        logger.error("Failed or skipped tests: %r", failed)
+        sys.exit(1)
 
 
 if __name__ == "__main__":